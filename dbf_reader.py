@@ -0,0 +1,146 @@
+"""
+DBF属性表快速读取工具
+使用内存映射读取定长记录块，并按整列解码，替代逐行解析的 simpledbf
+"""
+
+import os
+import codecs
+import numpy as np
+import pandas as pd
+
+
+# DBF文件头第29字节（语言驱动ID）与编码的对应关系
+LDID_ENCODINGS = {
+    0x01: 'cp437',
+    0x02: 'cp850',
+    0x03: 'cp1252',
+    0x13: 'cp932',
+    0x4D: 'cp936',
+    0x4E: 'cp949',
+    0x4F: 'cp950',
+    0x64: 'cp852',
+    0x65: 'cp866',
+    0x7A: 'cp936',
+    0x7B: 'cp932',
+    0x7C: 'cp874',
+    0x7D: 'cp1255',
+    0x7E: 'cp1256',
+    0xC8: 'cp1250',
+    0xC9: 'cp1251',
+    0xCA: 'cp1254',
+    0xCB: 'cp1253',
+}
+
+
+def read_dbf_header(dbf_path):
+    """
+    读取DBF文件头和字段描述
+    返回: (记录数, 文件头长度, 记录长度, 语言驱动ID, 字段列表)
+    字段列表元素为 (原始字段名bytes, 类型, 长度, 小数位数, 记录内偏移)
+    """
+    with open(dbf_path, 'rb') as f:
+        header = f.read(32)
+        if len(header) < 32:
+            raise ValueError(f"DBF文件头不完整: {dbf_path}")
+
+        n_records = int.from_bytes(header[4:8], 'little')
+        header_length = int.from_bytes(header[8:10], 'little')
+        record_length = int.from_bytes(header[10:12], 'little')
+        ldid = header[29]
+
+        fields = []
+        offset = 1  # 第一个字节为删除标记
+        while f.tell() + 32 <= header_length:
+            descriptor = f.read(32)
+            if descriptor[0] == 0x0D:
+                break
+            name = descriptor[:11].split(b'\x00')[0]
+            field_type = chr(descriptor[11])
+            length = descriptor[16]
+            decimals = descriptor[17]
+            fields.append((name, field_type, length, decimals, offset))
+            offset += length
+
+    return n_records, header_length, record_length, ldid, fields
+
+
+def detect_dbf_encoding(dbf_path, default='gbk'):
+    """
+    检测DBF编码：优先使用同名.cpg文件，其次使用文件头中的语言驱动ID
+    都无法确定时返回 default
+    """
+    cpg_path = os.path.splitext(dbf_path)[0] + '.cpg'
+    if os.path.exists(cpg_path):
+        with open(cpg_path, 'rb') as f:
+            codepage = f.read().decode('ascii', errors='ignore').strip()
+        # .cpg 内容可能为 'UTF-8'、'GBK'、'936' 或 'ANSI 1252' 等形式
+        digits = codepage.upper().replace('ANSI', '').strip()
+        if digits.isdigit():
+            codepage = 'cp' + digits
+        try:
+            return codecs.lookup(codepage).name
+        except LookupError:
+            pass
+
+    _, _, _, ldid, _ = read_dbf_header(dbf_path)
+    return LDID_ENCODINGS.get(ldid, default)
+
+
+def _decode_text_column(raw, encoding):
+    """整列拼接后一次性解码，再按换行符切分为各条记录"""
+    values = raw.tolist()
+    text = b'\n'.join(values).decode(encoding)
+    parts = text.split('\n')
+    if len(parts) != len(values):
+        # 字段内容本身包含换行符时，退回逐条解码
+        parts = [value.decode(encoding) for value in values]
+    return pd.Series(parts, dtype=object).str.strip()
+
+
+def read_dbf(dbf_path, encoding=None):
+    """
+    读取DBF属性表为DataFrame
+    encoding: 字符字段的编码，None表示按 detect_dbf_encoding 自动检测
+    注: 已删除的记录同样保留，保证与shp中的几何一一对应
+    """
+    if encoding is None:
+        encoding = detect_dbf_encoding(dbf_path)
+
+    n_records, header_length, record_length, _, fields = read_dbf_header(dbf_path)
+
+    # 以文件实际大小为准，防止文件头记录数与数据不符
+    available = max(os.path.getsize(dbf_path) - header_length, 0) // record_length if record_length else 0
+    n_records = min(n_records, available)
+
+    names = [name.decode(encoding, errors='replace').strip() for name, _, _, _, _ in fields]
+    if n_records == 0:
+        return pd.DataFrame(columns=names)
+
+    record_dtype = np.dtype({
+        'names': [f"f{i}" for i in range(len(fields))],
+        'formats': [f"S{length}" for _, _, length, _, _ in fields],
+        'offsets': [offset for _, _, _, _, offset in fields],
+        'itemsize': record_length
+    })
+    records = np.memmap(dbf_path, dtype=record_dtype, mode='r', offset=header_length, shape=(n_records,))
+
+    columns = {}
+    for i, (name, (_, field_type, _, decimals, _)) in enumerate(zip(names, fields)):
+        raw = records[f"f{i}"]
+
+        if field_type in ('N', 'F'):
+            values = pd.to_numeric(_decode_text_column(raw, 'latin1'), errors='coerce')
+            if field_type == 'N' and decimals == 0 and values.notna().any() and (values.dropna() % 1 == 0).all():
+                values = values.astype('Int64')
+        elif field_type == 'D':
+            values = pd.to_datetime(_decode_text_column(raw, 'latin1'), format='%Y%m%d', errors='coerce')
+        elif field_type == 'L':
+            flags = _decode_text_column(raw, 'latin1').str.upper()
+            values = flags.map(lambda v: True if v in ('T', 'Y') else (False if v in ('F', 'N') else None))
+        else:
+            values = _decode_text_column(raw, encoding)
+
+        columns[name] = values
+
+    del records
+    return pd.DataFrame(columns)
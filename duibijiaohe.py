@@ -6,12 +6,100 @@ import geopandas as gpd
 import pandas as pd
 import os
 import sys
+import json
+import time
+import tracemalloc
 from simpledbf import Dbf5
+from dbf_reader import read_dbf, detect_dbf_encoding
 
 
-def compare_reading_methods(shp_path):
+def benchmark_read(method, read_func, repeats=3):
     """
-    对比不同的读取方法
+    对一种读取方法进行基准测试，记录耗时、Python堆内存峰值和吞吐量
+    先预热读取一次（使文件进入系统缓存），再取 repeats 次计时中的最短耗时；
+    计时时不开启tracemalloc，内存峰值在单独的一次读取中统计
+    返回: (基准结果字典, 读取结果 或 None)
+    """
+    repeats = max(int(repeats), 1)
+    try:
+        data = read_func()
+
+        timings = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            read_func()
+            timings.append(time.perf_counter() - start)
+        seconds = min(timings)
+
+        tracemalloc.start()
+        try:
+            read_func()
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+        result = {
+            'method': method,
+            'success': True,
+            'seconds': round(seconds, 4),
+            'repeats': repeats,
+            'peak_mb': round(peak / 1024 / 1024, 2),
+            'features': len(data),
+            'fields': len(data.columns),
+            'has_geometry': 'geometry' in data.columns,
+            'attribute_fields': len([c for c in data.columns if c != 'geometry']),
+            'features_per_sec': round(len(data) / seconds, 1) if seconds > 0 else None
+        }
+        print(f"✅ {method}: 最短 {seconds:.3f} 秒 ({repeats} 次), 峰值 {result['peak_mb']} MB, "
+              f"{result['features']} 条记录, {result['fields']} 个字段")
+    except Exception as e:
+        data = None
+        error_msg = str(e)[:100] + "..." if len(str(e)) > 100 else str(e)
+        result = {'method': method, 'success': False, 'error': str(e)}
+        print(f"❌ {method}: {error_msg}")
+    return result, data
+
+
+def print_ranking(benchmarks):
+    """
+    按耗时排序打印推荐表
+    含几何的完整读取与只读属性表的方法分组排名；按属性字段数判断是否读取完整
+    """
+    successful = [b for b in benchmarks if b['success']]
+    if not successful:
+        print("❌ 没有成功的读取方法")
+        return []
+
+    max_attributes = max(b['attribute_fields'] for b in successful)
+    ranked = []
+    groups = [('完整读取 (几何+属性)', [b for b in successful if b['has_geometry']]),
+              ('仅属性表', [b for b in successful if not b['has_geometry']])]
+
+    for title, group in groups:
+        if not group:
+            continue
+        group = sorted(group, key=lambda b: (b['attribute_fields'] < max_attributes, b['seconds']))
+        print(f"\n{title}:")
+        print(f"{'排名':<4} {'方法':<40} {'耗时(秒)':>10} {'峰值(MB)':>10} {'要素/秒':>12} {'属性字段':>8}")
+        for rank, b in enumerate(group, 1):
+            note = "" if b['attribute_fields'] == max_attributes else "  (字段不完整)"
+            print(f"{rank:<4} {b['method']:<40} {b['seconds']:>10.3f} {b['peak_mb']:>10.2f} "
+                  f"{b['features_per_sec'] or 0:>12.1f} {b['attribute_fields']:>8}{note}")
+        ranked.extend(group)
+
+    failed = [b for b in benchmarks if not b['success']]
+    if failed:
+        print(f"失败的方法: {', '.join(b['method'] for b in failed)}")
+    print(f"\n推荐: {ranked[0]['method']}")
+    return ranked
+
+
+def compare_reading_methods(shp_path, json_output=None, repeats=3):
+    """
+    对比不同的读取方法，并对各方法的耗时、内存峰值和吞吐量进行基准测试
+    json_output: 可选，基准结果导出的JSON文件路径
+    repeats: 每种方法预热后的计时次数，取最短耗时
+    注: 内存峰值由tracemalloc统计，只包含Python堆分配，不含GDAL内部的C内存
     """
     print("=" * 80)
     print("Shapefile 读取方法对比测试")
@@ -22,6 +110,8 @@ def compare_reading_methods(shp_path):
         return
 
     base_path = os.path.splitext(shp_path)[0]
+    dbf_path = base_path + '.dbf'
+    benchmarks = []
 
     # 方法1: 诊断工具的读取方式
     print(f"\n【方法1】诊断工具的读取方式 (多种编码尝试)")
@@ -29,25 +119,24 @@ def compare_reading_methods(shp_path):
 
     encodings = ['utf-8', 'gbk', 'gb2312', 'latin1', 'cp1252']
     best_result = None
+    gbk_gdf = None
 
     for encoding in encodings:
-        try:
-            print(f"尝试编码: {encoding}")
-            gdf = gpd.read_file(shp_path, encoding=encoding)
-            print(f"✅ 成功读取")
-            print(f"   字段数: {len(gdf.columns)}")
-            print(f"   字段列表: {list(gdf.columns)}")
-
-            if best_result is None or len(gdf.columns) > best_result['fields']:
-                best_result = {
-                    'encoding': encoding,
-                    'gdf': gdf,
-                    'fields': len(gdf.columns)
-                }
-
-        except Exception as e:
-            error_msg = str(e)[:100] + "..." if len(str(e)) > 100 else str(e)
-            print(f"❌ 失败: {error_msg}")
+        result, gdf = benchmark_read(f"gpd.read_file encoding={encoding}",
+                                     lambda: gpd.read_file(shp_path, encoding=encoding), repeats)
+        benchmarks.append(result)
+        if gdf is None:
+            continue
+        print(f"   字段列表: {list(gdf.columns)}")
+        if encoding == 'gbk':
+            gbk_gdf = gdf
+
+        if best_result is None or len(gdf.columns) > best_result['fields']:
+            best_result = {
+                'encoding': encoding,
+                'gdf': gdf,
+                'fields': len(gdf.columns)
+            }
 
     if best_result:
         print(f"\n最佳结果: 使用编码 '{best_result['encoding']}'")
@@ -56,59 +145,64 @@ def compare_reading_methods(shp_path):
         print(f"\n❌ 所有编码都失败")
         diag_gdf = None
 
-    # 方法2: 主程序的读取方式 (GBK优先)
+    # 方法2: 主程序的读取方式 (GBK优先，失败时直接读取dbf)
+    # GBK读取结果已在方法1中计时，这里不再重复读取
     print(f"\n【方法2】主程序的读取方式 (GBK优先)")
     print("-" * 60)
 
-    main_gdf = None
+    main_gdf = gbk_gdf
     main_error = None
 
-    try:
-        print(f"尝试GBK编码...")
-        main_gdf = gpd.read_file(shp_path, encoding='gbk')
-        print(f"✅ 成功读取")
-        print(f"   字段数: {len(main_gdf.columns)}")
-        print(f"   字段列表: {list(main_gdf.columns)}")
-
-    except Exception as e:
-        main_error = str(e)
-        print(f"❌ GBK编码失败: {main_error[:150]}")
-
-        # 尝试直接读取dbf
-        try:
-            dbf_path = base_path + '.dbf'
-            if os.path.exists(dbf_path):
-                print(f"\n尝试直接读取dbf文件...")
-                dbf = Dbf5(dbf_path, codec='gbk')
-                df_dbf = dbf.to_dataframe()
-                print(f"✅ 成功读取dbf")
-
-                # 读取geometry
-                gdf_geo = gpd.read_file(shp_path)
-
-                # 合并
-                if len(df_dbf) == len(gdf_geo):
-                    main_gdf = pd.concat([gdf_geo, df_dbf], axis=1)
-                    print(f"✅ 成功合并数据")
-                    print(f"   字段数: {len(main_gdf.columns)}")
-
-        except Exception as e2:
-            print(f"❌ 直接读取dbf也失败: {str(e2)[:100]}")
-
-    # 方法3: 直接使用诊断工具找到的最佳编码
-    print(f"\n【方法3】使用诊断工具找到的最佳编码")
+    if os.path.exists(dbf_path):
+        print(f"直接读取dbf文件 (simpledbf)...")
+        result, df_dbf = benchmark_read("simpledbf.Dbf5 encoding=gbk",
+                                        lambda: Dbf5(dbf_path, codec='gbk').to_dataframe(), repeats)
+        benchmarks.append(result)
+
+        dbf_encoding = detect_dbf_encoding(dbf_path)
+        print(f"直接读取dbf文件 (dbf_reader，内存映射按列解码，编码 {dbf_encoding})...")
+        result, _ = benchmark_read(f"dbf_reader.read_dbf encoding={dbf_encoding}",
+                                   lambda: read_dbf(dbf_path, dbf_encoding), repeats)
+        benchmarks.append(result)
+
+        print(f"直接读取dbf并合并geometry...")
+        result, merged_gdf = benchmark_read(
+            "simpledbf.Dbf5 + gpd.read_file 合并",
+            lambda: pd.concat([gpd.read_file(shp_path)[['geometry']],
+                               Dbf5(dbf_path, codec='gbk').to_dataframe()], axis=1), repeats)
+        benchmarks.append(result)
+
+        if main_gdf is None:
+            main_gdf = merged_gdf
+            if merged_gdf is None:
+                main_error = result.get('error')
+    elif main_gdf is None:
+        main_error = "GBK编码读取失败且DBF文件不存在"
+
+    # 方法3: 使用最佳编码对比不同的I/O引擎
+    print(f"\n【方法3】使用诊断工具找到的最佳编码，对比I/O引擎")
     print("-" * 60)
 
     if best_result:
-        try:
-            print(f"使用编码 '{best_result['encoding']}'...")
-            optimized_gdf = gpd.read_file(shp_path, encoding=best_result['encoding'])
-            print(f"✅ 成功读取")
-            print(f"   字段数: {len(optimized_gdf.columns)}")
-            print(f"   字段列表: {list(optimized_gdf.columns)}")
+        for engine in ['fiona', 'pyogrio']:
+            result, _ = benchmark_read(
+                f"gpd.read_file engine={engine} encoding={best_result['encoding']}",
+                lambda: gpd.read_file(shp_path, encoding=best_result['encoding'], engine=engine), repeats)
+            benchmarks.append(result)
+
+    # 基准测试排名
+    print(f"\n【读取策略基准测试排名】")
+    print("-" * 60)
+    ranked = print_ranking(benchmarks)
 
-        except Exception as e:
-            print(f"❌ 失败: {str(e)[:100]}")
+    if json_output:
+        with open(json_output, 'w', encoding='utf-8') as f:
+            json.dump({
+                'file': shp_path,
+                'benchmarks': benchmarks,
+                'ranking': [b['method'] for b in ranked]
+            }, f, ensure_ascii=False, indent=2)
+        print(f"✅ 基准结果已导出至: {json_output}")
 
     # 对比结果
     print(f"\n【对比结果】")
@@ -169,7 +263,7 @@ except Exception as e:
         print(fix_code)
 
 
-def test_specific_file(shp_path):
+def test_specific_file(shp_path, json_output=None, repeats=3):
     """测试特定文件"""
     print(f"测试文件: {shp_path}")
     print("=" * 60)
@@ -190,14 +284,16 @@ def test_specific_file(shp_path):
                 print(f"  {ext}: 缺失")
 
     # 运行对比测试
-    compare_reading_methods(shp_path)
+    compare_reading_methods(shp_path, json_output, repeats)
 
 
 if __name__ == "__main__":
     if len(sys.argv) > 1:
         shp_path = sys.argv[1]
-        test_specific_file(shp_path)
+        json_output = sys.argv[sys.argv.index('--json') + 1] if '--json' in sys.argv[2:-1] else None
+        repeats = int(sys.argv[sys.argv.index('--repeats') + 1]) if '--repeats' in sys.argv[2:-1] else 3
+        test_specific_file(shp_path, json_output, repeats)
     else:
         print("使用方法:")
-        print("python compare_reading.py path/to/your/file.shp")
-        print("\n这个工具会对比不同的读取方法，找出最佳解决方案")
+        print("python duibijiaohe.py path/to/your/file.shp [--json benchmark.json] [--repeats 3]")
+        print("\n这个工具会对比不同的读取方法并进行基准测试，找出最佳解决方案")
@@ -8,16 +8,74 @@ output_shp = './驿都大道OD.shp'  # 相对路径：输出文件路径
 target_tazs = {53621, 53622, 53623, 53624, 53625, 53626, 53642, 53641, 53295, 53307, 53611, 53613, 53616, 53617, 53618,
                53619, 53620, 53627, 53298, 53628, 53313, 53607, 53610, 53612, 53310, 53312, 53299, 53374, 53308, 53326,
                53932, 53943, 53944, 53945, 53946, 53947, 53948, 53953, }  # 根据需求填写
+
+# 距离筛选（按小区中心点直线距离，米），在提取流量和构建期望线之前完成，设为None表示不限制
+min_distance = None  # 只保留距离 >= 该值的OD对，如 5000 表示只要5公里以上的长距离期望线
+max_distance = None  # 只保留距离 <= 该值的OD对，如 3000 表示只要短距离的局部出行
+
+# 出行距离统计（向量化计算，不构建几何），设为None则不输出
+stats_output = './驿都大道OD_距离统计.csv'  # 相对路径：距离统计表输出路径
+stats_scope = 'target'  # 'target'=仅统计目标小区之间, 'all'=统计全市OD矩阵
+distance_bands = [0, 1000, 3000, 5000, 10000, 20000]  # 距离分段边界（米），最后一段为大于最后一个值；首个边界大于0时自动补0
+histogram_bin_width = 500  # 出行距离直方图的组距（米）
+
+# 分片并行输出（超大输出时使用，避免单个Shapefile超过2GB），设为None则输出单个文件
+shard_mode = None  # None / 'origin'=按起点小区编号范围分片 / 'tile'=按起点所在空间瓦片分片
+shard_output_dir = './驿都大道OD_分片'  # 相对路径：分片及索引文件(manifest.json)的输出目录
+shard_max_features = 200000  # 'origin'模式下每个分片的最大线数
+shard_tile_size = 10000  # 'tile'模式下瓦片边长（米）
+shard_workers = 4  # 并行写出的线程数
+
+# OD变化检测（对比两期OD矩阵，如道路开通前后），设为None则不启用
+# 基准期子矩阵直接从步骤1已读取的矩阵中切出，对比期矩阵只读取目标小区之间的子矩阵
+compare_csv_file = None  # 相对路径：对比期OD矩阵文件
+compare_output_shp = './驿都大道OD_变化.shp'  # 相对路径：变化期望线输出路径
+change_abs_threshold = 50  # 绝对变化阈值：|对比期-基准期| >= 该值
+change_rel_threshold = 0.2  # 相对变化阈值：|对比期-基准期|/基准期 >= 该值（基准期为0的新增OD视为通过）
+
+# 期望线密度栅格（流量×穿越长度累加到格网），设为None则不输出
+density_output = None  # 相对路径：'.tif'输出GeoTIFF（需要rasterio），'.npy'输出NumPy数组
+density_cell_size = 200  # 栅格边长（米，投影坐标系单位）
+density_extent = None  # 栅格范围 (minx, miny, maxx, maxy)，None表示使用交通小区图层范围
+
+# 流式输出换行分隔GeoJSON（NDJSON），边筛选边写出，内存占用只与分块大小有关
+ndjson_output = None  # 相对路径：NDJSON输出文件；'-'表示输出到标准输出（用于管道）；启用后跳过步骤5-6
+stream_chunk_size = 50000  # 每块处理的OD单元数（起点数 x 终点数）
+
+# 本地查询服务：常驻内存保存OD矩阵和中心点，按目标小区集合返回期望线，设为None则不启用
+# 启用后在步骤3完成时进入服务模式（仅监听127.0.0.1），按Ctrl+C退出
+serve_port = None  # 服务端口，如 8765
+serve_cache_mb = 256  # 已提取子矩阵的LRU缓存上限（MB）
+
+# 结果缓存：输入文件内容、目标小区和以上所有选项都未变化时，直接复制上次的输出并跳过计算，设为None则不启用
+cache_dir = None  # 相对路径：缓存目录，如 './.od_cache'（建议只在定时任务中启用）
+cache_max_mb = 2048  # 缓存目录大小上限（MB），超出时淘汰最久未使用的结果
 # =====================
 
 # 智能编码检测版本 - 自动找到最佳编码
 # 结合了诊断工具和主程序的优点
 
+import numpy as np
 import pandas as pd
 import geopandas as gpd
 from shapely.geometry import LineString
 import os
 import glob
+import sys
+import json
+import time
+import shutil
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# 期望线输出到标准输出时，进度信息改为输出到标准错误，避免混入数据流
+ndjson_stream = None
+if ndjson_output == '-':
+    ndjson_stream = sys.stdout
+    sys.stdout = sys.stderr
 
 print("=" * 60)
 print("交通小区OD期望线生成工具 - 智能编码检测版")
@@ -118,6 +176,836 @@ def find_best_encoding(file_path):
             return None, None
 
 
+def _bin_by_edges(dist, flow, edges):
+    """按距离边界分组，返回每组的OD对数、流量和流量加权距离之和"""
+    idx = np.searchsorted(edges, dist, side='right') - 1
+    idx = np.clip(idx, 0, len(edges) - 2)
+    n_bins = len(edges) - 1
+    pairs = np.bincount(idx, minlength=n_bins)
+    flows = np.bincount(idx, weights=flow, minlength=n_bins)
+    dist_sum = np.bincount(idx, weights=flow * dist, minlength=n_bins)
+    return pairs, flows, dist_sum
+
+
+def compute_trip_length_stats(od_block, centroid_xy, band_edges, bin_width, min_dist=None, max_dist=None):
+    """
+    向量化计算流量加权的出行距离分布（不构建任何几何）
+    od_block: OD矩阵（行=起点TAZ，列=终点TAZ）
+    centroid_xy: 以TAZ编号为索引、包含x/y列的中心点坐标表
+    min_dist/max_dist: 可选的距离范围（米），与期望线使用相同的距离筛选
+    返回: (统计表DataFrame, 无坐标的流量)
+    """
+    origin_ids = pd.to_numeric(pd.Index(od_block.index), errors='coerce')
+    dest_ids = pd.to_numeric(pd.Index(od_block.columns), errors='coerce')
+    values = od_block.to_numpy(dtype=float)
+
+    # 一次性取出所有有流量的OD对
+    rows, cols = np.nonzero(values > 0)
+    flow = values[rows, cols]
+
+    ox = centroid_xy['x'].reindex(origin_ids).to_numpy()[rows]
+    oy = centroid_xy['y'].reindex(origin_ids).to_numpy()[rows]
+    dx = centroid_xy['x'].reindex(dest_ids).to_numpy()[cols]
+    dy = centroid_xy['y'].reindex(dest_ids).to_numpy()[cols]
+    dist = np.hypot(dx - ox, dy - oy)
+
+    located = ~np.isnan(dist)
+    missing_flow = flow[~located].sum()
+    intrazonal = np.asarray(origin_ids)[rows] == np.asarray(dest_ids)[cols]
+
+    # 只统计距离范围内的OD对
+    keep = located.copy()
+    if min_dist is not None:
+        keep &= dist >= min_dist
+    if max_dist is not None:
+        keep &= dist <= max_dist
+    intrazonal, dist, flow = intrazonal[keep], dist[keep], flow[keep]
+    total_flow = flow.sum()
+
+    records = []
+
+    def add_rows(category, edges, labels):
+        pairs, flows, dist_sum = _bin_by_edges(dist, flow, edges)
+        for i, label in enumerate(labels):
+            records.append({
+                'Category': category,
+                'Item': label,
+                'Lower': edges[i],
+                'Upper': edges[i + 1],
+                'Pairs': int(pairs[i]),
+                'Flow': flows[i],
+                'Share': flows[i] / total_flow if total_flow > 0 else 0.0,
+                'MeanDist': dist_sum[i] / flows[i] if flows[i] > 0 else np.nan
+            })
+
+    # 出行距离直方图
+    max_dist = dist.max() if len(dist) else 0.0
+    hist_edges = np.arange(0, max_dist + bin_width, bin_width, dtype=float)
+    if len(hist_edges) < 2:
+        hist_edges = np.array([0.0, float(bin_width)])
+    add_rows('histogram', hist_edges,
+             [f"{hist_edges[i]:.0f}-{hist_edges[i + 1]:.0f}" for i in range(len(hist_edges) - 1)])
+
+    # 距离分段汇总（最后一段为开区间）
+    band_edges = np.asarray(sorted(band_edges), dtype=float)
+    # 第一个边界大于0时补上0，避免更短的出行被计入第一段
+    if len(band_edges) == 0 or band_edges[0] > 0:
+        band_edges = np.insert(band_edges, 0, 0.0)
+    band_edges = np.append(band_edges, np.inf)
+    add_rows('band', band_edges,
+             [f"{band_edges[i]:.0f}-{band_edges[i + 1]:.0f}" if np.isfinite(band_edges[i + 1])
+              else f">{band_edges[i]:.0f}" for i in range(len(band_edges) - 1)])
+
+    # 区内出行与总计
+    for category, mask in [('intrazonal', intrazonal), ('total', np.ones(len(flow), dtype=bool))]:
+        category_flow = flow[mask].sum()
+        records.append({
+            'Category': category,
+            'Item': category,
+            'Lower': np.nan,
+            'Upper': np.nan,
+            'Pairs': int(mask.sum()),
+            'Flow': category_flow,
+            'Share': category_flow / total_flow if total_flow > 0 else 0.0,
+            'MeanDist': (flow[mask] * dist[mask]).sum() / category_flow if category_flow > 0 else np.nan
+        })
+
+    return pd.DataFrame(records), missing_flow
+
+
+def assign_shards(gdf_lines, centroid_xy, mode, max_features, tile_size):
+    """
+    为每条期望线分配分片编号
+    返回: (分片编号数组, {分片编号: 分片描述})
+    """
+    origins = gdf_lines['Origin_TAZ'].to_numpy()
+
+    if mode == 'origin':
+        # 按起点编号顺序装箱：加入下一个起点会超过上限时开始新分片，同一起点的线始终在同一分片
+        # （单个起点的线数本身超过上限时独占一个分片）
+        origin_counts = gdf_lines.groupby('Origin_TAZ').size().sort_index()
+        shard_of_origin = []
+        shard_id, shard_count = 0, 0
+        for count in origin_counts.to_numpy():
+            if shard_count > 0 and shard_count + count > max_features:
+                shard_id += 1
+                shard_count = 0
+            shard_of_origin.append(shard_id)
+            shard_count += count
+        origin_shard = pd.Series(shard_of_origin, index=origin_counts.index)
+        shard_ids = origin_shard.reindex(origins).to_numpy()
+        shard_info = {}
+        for shard_id, group in origin_shard.groupby(origin_shard):
+            shard_info[int(shard_id)] = {
+                'origin_min': int(group.index.min()),
+                'origin_max': int(group.index.max())
+            }
+        return shard_ids, shard_info
+
+    if mode == 'tile':
+        # 按起点中心点所在的瓦片分片
+        ox = centroid_xy['x'].reindex(origins).to_numpy()
+        oy = centroid_xy['y'].reindex(origins).to_numpy()
+        tile_x = np.floor(ox / tile_size).astype('int64')
+        tile_y = np.floor(oy / tile_size).astype('int64')
+        tiles, shard_ids = np.unique(np.stack([tile_x, tile_y], axis=1), axis=0, return_inverse=True)
+        shard_info = {}
+        for shard_id, (tx, ty) in enumerate(tiles):
+            tx, ty = int(tx), int(ty)
+            shard_info[shard_id] = {
+                'tile': [tx, ty],
+                'tile_bounds': [float(tx * tile_size), float(ty * tile_size),
+                                float((tx + 1) * tile_size), float((ty + 1) * tile_size)]
+            }
+        return shard_ids.ravel(), shard_info
+
+    raise ValueError(f"未知的分片模式: {mode}")
+
+
+def write_shard(gdf_shard, shard_path, encodings):
+    """写出单个分片，依次尝试编码，返回成功使用的编码"""
+    last_error = None
+    for encoding in encodings:
+        try:
+            gdf_shard.to_file(shard_path, driver='ESRI Shapefile', encoding=encoding)
+            return encoding
+        except Exception as e:
+            last_error = e
+    raise RuntimeError(f"分片 {shard_path} 保存失败: {last_error}")
+
+
+def write_sharded_lines(gdf_lines, centroid_xy, output_dir, mode, max_features, tile_size, workers, encodings):
+    """
+    将期望线按分片并行写出，并生成索引文件 manifest.json
+    返回: 索引文件路径
+    """
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+        print(f"创建分片输出目录: {output_dir}")
+
+    shard_ids, shard_info = assign_shards(gdf_lines, centroid_xy, mode, max_features, tile_size)
+    groups = pd.Series(np.arange(len(gdf_lines))).groupby(shard_ids).indices
+    print(f"分片模式: {mode}，共 {len(groups)} 个分片，使用 {workers} 个线程写出")
+
+    tasks = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for shard_id, positions in groups.items():
+            shard_file = f"shard_{int(shard_id):05d}.shp"
+            gdf_shard = gdf_lines.iloc[positions]
+            future = executor.submit(write_shard, gdf_shard, os.path.join(output_dir, shard_file), encodings)
+            tasks[int(shard_id)] = (shard_file, gdf_shard, future)
+
+        shards = []
+        for shard_id, (shard_file, gdf_shard, future) in sorted(tasks.items()):
+            encoding = future.result()
+            entry = {
+                'file': shard_file,
+                'features': len(gdf_shard),
+                'encoding': encoding,
+                'bounds': [float(v) for v in gdf_shard.total_bounds]
+            }
+            entry.update(shard_info.get(shard_id, {}))
+            shards.append(entry)
+            print(f"  ✅ {shard_file}: {len(gdf_shard)} 条线")
+
+    manifest = {
+        'mode': mode,
+        'crs': gdf_lines.crs.to_string() if gdf_lines.crs else None,
+        'fields': [c for c in gdf_lines.columns if c != 'geometry'],
+        'total_features': len(gdf_lines),
+        'shards': shards
+    }
+    manifest_path = os.path.join(output_dir, 'manifest.json')
+    with open(manifest_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+
+    # 验证索引文件可读且与写出的分片一致
+    with open(manifest_path, 'r', encoding='utf-8') as f:
+        saved_manifest = json.load(f)
+    if len(saved_manifest['shards']) != len(groups) or \
+            sum(shard['features'] for shard in saved_manifest['shards']) != len(gdf_lines):
+        raise ValueError(f"索引文件与分片不一致: {manifest_path}")
+    print(f"✅ 索引文件验证成功: {len(saved_manifest['shards'])} 个分片")
+    return manifest_path
+
+
+def rasterize_desire_lines(ox, oy, dx, dy, flow, extent, cell_size, grid=None, max_samples=5_000_000):
+    """
+    将流量加权的期望线累加到规则格网上（向量化沿线采样，不构建几何）
+    每条线按不超过半个格网的间距采样，每个采样点代表 流量×线长/采样数，
+    因此每个格网的值为穿过该格网的 流量×长度。
+    grid: 可选，已有的同范围格网，分块调用时在其上继续累加
+    返回: (二维数组，行从北到南, (minx, maxy) 左上角坐标)
+    """
+    minx, miny, maxx, maxy = extent
+    n_cols = max(int(np.ceil((maxx - minx) / cell_size)), 1)
+    n_rows = max(int(np.ceil((maxy - miny) / cell_size)), 1)
+    grid = np.zeros(n_rows * n_cols, dtype=float) if grid is None else grid.reshape(-1)
+
+    length = np.hypot(dx - ox, dy - oy)
+    n_samples = np.maximum(np.ceil(length / (cell_size / 2)).astype('int64'), 1)
+    sample_weight = flow * length / n_samples
+
+    # 按采样点总数分块，控制内存
+    cum_samples = np.cumsum(n_samples)
+    start = 0
+    while start < len(n_samples):
+        base = cum_samples[start - 1] if start > 0 else 0
+        stop = max(int(np.searchsorted(cum_samples, base + max_samples, side='right')), start + 1)
+        counts = n_samples[start:stop]
+
+        line_idx = np.repeat(np.arange(start, stop), counts)
+        first_sample = np.repeat(np.cumsum(counts) - counts, counts)
+        t = (np.arange(counts.sum()) - first_sample + 0.5) / n_samples[line_idx]
+        px = ox[line_idx] + t * (dx - ox)[line_idx]
+        py = oy[line_idx] + t * (dy - oy)[line_idx]
+
+        col = np.floor((px - minx) / cell_size).astype('int64')
+        row = np.floor((maxy - py) / cell_size).astype('int64')
+        inside = (col >= 0) & (col < n_cols) & (row >= 0) & (row < n_rows)
+        grid += np.bincount(row[inside] * n_cols + col[inside],
+                            weights=sample_weight[line_idx][inside], minlength=grid.size)
+        start = stop
+
+    return grid.reshape(n_rows, n_cols), (minx, maxy)
+
+
+def save_density_raster(grid, origin, cell_size, crs, output_path):
+    """保存密度栅格：.tif使用rasterio写出GeoTIFF，否则（或rasterio不可用时）写出.npy及坐标说明.json"""
+    minx, maxy = origin
+    if output_path.lower().endswith(('.tif', '.tiff')):
+        try:
+            import rasterio
+            from rasterio.transform import from_origin
+
+            with rasterio.open(output_path, 'w', driver='GTiff', height=grid.shape[0], width=grid.shape[1],
+                               count=1, dtype='float32', crs=crs.to_wkt() if crs else None,
+                               transform=from_origin(minx, maxy, cell_size, cell_size),
+                               compress='deflate', nodata=0) as dst:
+                dst.write(grid.astype('float32'), 1)
+            return output_path
+        except ImportError:
+            print(f"⚠️  未安装rasterio，改为输出NumPy数组")
+            output_path = os.path.splitext(output_path)[0] + '.npy'
+
+    np.save(output_path, grid.astype('float32'))
+    with open(os.path.splitext(output_path)[0] + '.json', 'w', encoding='utf-8') as f:
+        json.dump({
+            'origin_x': minx,
+            'origin_y': maxy,
+            'cell_size': cell_size,
+            'shape': list(grid.shape),
+            'row_order': 'north_to_south',
+            'crs': crs.to_string() if crs else None
+        }, f, ensure_ascii=False, indent=2)
+    return output_path
+
+
+def select_pairs_by_distance(origins, dests, centroid_xy, min_dist=None, max_dist=None, dense_limit=4_000_000):
+    """
+    按中心点距离筛选OD对，不读取任何流量
+    有最大距离且OD单元数超过 dense_limit 时，用KD树（scipy）只查询半径内的终点；
+    否则按起点分块计算距离矩阵并用掩膜筛选
+    返回: (起点在origins中的位置数组, 终点在dests中的位置数组)
+    """
+    ox = centroid_xy['x'].reindex(pd.to_numeric(pd.Index(origins), errors='coerce')).to_numpy()
+    oy = centroid_xy['y'].reindex(pd.to_numeric(pd.Index(origins), errors='coerce')).to_numpy()
+    dx = centroid_xy['x'].reindex(pd.to_numeric(pd.Index(dests), errors='coerce')).to_numpy()
+    dy = centroid_xy['y'].reindex(pd.to_numeric(pd.Index(dests), errors='coerce')).to_numpy()
+    origin_pos = np.nonzero(~np.isnan(ox))[0]
+    dest_pos = np.nonzero(~np.isnan(dx))[0]
+    if len(origin_pos) == 0 or len(dest_pos) == 0:
+        return np.empty(0, dtype='int64'), np.empty(0, dtype='int64')
+
+    if max_dist is not None and len(origin_pos) * len(dest_pos) > dense_limit:
+        try:
+            from scipy.spatial import cKDTree
+
+            tree = cKDTree(np.column_stack([dx[dest_pos], dy[dest_pos]]))
+            neighbours = tree.query_ball_point(np.column_stack([ox[origin_pos], oy[origin_pos]]), r=max_dist)
+            counts = np.array([len(n) for n in neighbours], dtype='int64')
+            rows = np.repeat(origin_pos, counts)
+            cols = dest_pos[np.concatenate([np.asarray(n, dtype='int64') for n in neighbours])] \
+                if counts.sum() > 0 else np.empty(0, dtype='int64')
+            if min_dist is not None:
+                keep = np.hypot(dx[cols] - ox[rows], dy[cols] - oy[rows]) >= min_dist
+                rows, cols = rows[keep], cols[keep]
+            return rows, cols
+        except ImportError:
+            print(f"⚠️  未安装scipy，改用分块距离矩阵筛选")
+
+    rows_per_chunk = max(dense_limit // len(dest_pos), 1)
+    row_parts, col_parts = [], []
+    for start in range(0, len(origin_pos), rows_per_chunk):
+        chunk = origin_pos[start:start + rows_per_chunk]
+        dist = np.hypot(dx[dest_pos][None, :] - ox[chunk][:, None], dy[dest_pos][None, :] - oy[chunk][:, None])
+        mask = np.ones(dist.shape, dtype=bool)
+        if min_dist is not None:
+            mask &= dist >= min_dist
+        if max_dist is not None:
+            mask &= dist <= max_dist
+        r, c = np.nonzero(mask)
+        row_parts.append(chunk[r])
+        col_parts.append(dest_pos[c])
+    return np.concatenate(row_parts), np.concatenate(col_parts)
+
+
+def iter_desire_line_chunks(df_od, origins, dests, centroid_xy, chunk_size, min_dist=None, max_dist=None):
+    """
+    按起点分块从OD子矩阵中生成期望线，每块最多处理 chunk_size 个OD单元
+    逐块产出包含起终点、流量、长度和端点坐标的DataFrame
+    min_dist/max_dist: 可选的距离范围（米），在取流量前按距离掩膜筛选
+    """
+    dests = [d for d in dests if d in df_od.columns]
+    dest_ids = pd.to_numeric(pd.Index(dests), errors='coerce')
+    dx = centroid_xy['x'].reindex(dest_ids).to_numpy()
+    dy = centroid_xy['y'].reindex(dest_ids).to_numpy()
+    rows_per_chunk = max(chunk_size // max(len(dests), 1), 1)
+
+    for start in range(0, len(origins), rows_per_chunk):
+        chunk_origins = origins[start:start + rows_per_chunk]
+        values = df_od.loc[chunk_origins, dests].to_numpy(dtype=float)
+        ox = centroid_xy['x'].reindex(pd.to_numeric(pd.Index(chunk_origins), errors='coerce')).to_numpy()
+        oy = centroid_xy['y'].reindex(pd.to_numeric(pd.Index(chunk_origins), errors='coerce')).to_numpy()
+
+        rows, cols = np.nonzero(values > 0)
+        located = ~np.isnan(ox[rows]) & ~np.isnan(dx[cols])
+        rows, cols = rows[located], cols[located]
+        if min_dist is not None or max_dist is not None:
+            dist = np.hypot(dx[cols] - ox[rows], dy[cols] - oy[rows])
+            in_band = np.ones(len(dist), dtype=bool)
+            if min_dist is not None:
+                in_band &= dist >= min_dist
+            if max_dist is not None:
+                in_band &= dist <= max_dist
+            rows, cols = rows[in_band], cols[in_band]
+        if len(rows) == 0:
+            continue
+
+        yield pd.DataFrame({
+            'Origin_TAZ': np.asarray(chunk_origins)[rows],
+            'Destination_TAZ': np.asarray(dest_ids)[cols],
+            'Flow': values[rows, cols],
+            'Length': np.hypot(dx[cols] - ox[rows], dy[cols] - oy[rows]),
+            'x0': ox[rows],
+            'y0': oy[rows],
+            'x1': dx[cols],
+            'y1': dy[cols]
+        })
+
+
+def iter_geojson_features(chunk):
+    """将一块期望线（iter_desire_line_chunks的输出格式）逐条转换为GeoJSON Feature"""
+    for origin, dest, flow, length, x0, y0, x1, y1 in zip(
+            chunk['Origin_TAZ'].tolist(), chunk['Destination_TAZ'].tolist(), chunk['Flow'].tolist(),
+            chunk['Length'].tolist(), chunk['x0'].tolist(), chunk['y0'].tolist(),
+            chunk['x1'].tolist(), chunk['y1'].tolist()):
+        yield {
+            'type': 'Feature',
+            'geometry': {'type': 'LineString', 'coordinates': [[x0, y0], [x1, y1]]},
+            'properties': {'Origin_TAZ': origin, 'Destination_TAZ': dest, 'Flow': flow, 'Length': length}
+        }
+
+
+def write_ndjson_lines(chunks, stream):
+    """将期望线分块逐行写出为GeoJSON Feature（每行一个），返回写出的线数"""
+    count = 0
+    for chunk in chunks:
+        for feature in iter_geojson_features(chunk):
+            stream.write(json.dumps(feature, ensure_ascii=False) + '\n')
+        count += len(chunk)
+    stream.flush()
+    return count
+
+
+class ODRowCache:
+    """
+    已提取OD行的LRU缓存：键为起点TAZ，值为该起点有流量的 (终点编号数组, 流量数组)
+    按占用字节数限制大小，超出时淘汰最久未使用的行
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._rows = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, origin):
+        with self._lock:
+            row = self._rows.get(origin)
+            if row is None:
+                self.misses += 1
+                return None
+            self._rows.move_to_end(origin)
+            self.hits += 1
+            return row
+
+    def put(self, origin, row):
+        size = row[0].nbytes + row[1].nbytes
+        with self._lock:
+            if origin in self._rows:
+                return
+            self._rows[origin] = row
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes and len(self._rows) > 1:
+                _, (old_dests, old_flows) = self._rows.popitem(last=False)
+                self.current_bytes -= old_dests.nbytes + old_flows.nbytes
+
+    def stats(self):
+        with self._lock:
+            return {
+                'rows': len(self._rows),
+                'bytes': self.current_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses
+            }
+
+
+def query_desire_lines(od_values, origin_positions, dest_ids, centroid_xy, cache, origins, dests, min_flow=0,
+                       min_dist=None, max_dist=None):
+    """
+    查询起点集合到终点集合之间的期望线，OD行优先从缓存读取
+    min_dist/max_dist: 可选的距离范围（米），先按中心点距离选出OD对再取流量
+    返回: 与 iter_desire_line_chunks 输出格式相同的DataFrame
+    """
+    dest_filter = np.asarray(sorted(dests), dtype='int64')
+    origin_list, dest_list, flow_list = [], [], []
+
+    allowed_pairs = None
+    if min_dist is not None or max_dist is not None:
+        pair_rows, pair_cols = select_pairs_by_distance(origins, list(dest_filter), centroid_xy, min_dist, max_dist)
+        allowed_pairs = pd.DataFrame({
+            'Origin_TAZ': np.asarray(origins, dtype='int64')[pair_rows],
+            'Destination_TAZ': dest_filter[pair_cols]
+        })
+        origins = allowed_pairs['Origin_TAZ'].unique().tolist()
+
+    for origin in origins:
+        row = cache.get(origin)
+        if row is None:
+            position = origin_positions.get(origin)
+            if position is None:
+                continue
+            values = od_values[position]
+            nonzero = np.nonzero(values > 0)[0]
+            row = (dest_ids[nonzero], values[nonzero])
+            cache.put(origin, row)
+
+        row_dests, row_flows = row
+        keep = np.isin(row_dests, dest_filter) & (row_flows >= min_flow)
+        origin_list.append(np.full(keep.sum(), origin, dtype='int64'))
+        dest_list.append(row_dests[keep])
+        flow_list.append(row_flows[keep])
+
+    if not origin_list:
+        origin_list, dest_list, flow_list = [np.empty(0, dtype='int64')], [np.empty(0, dtype='int64')], [np.empty(0)]
+    result = pd.DataFrame({
+        'Origin_TAZ': np.concatenate(origin_list),
+        'Destination_TAZ': np.concatenate(dest_list),
+        'Flow': np.concatenate(flow_list)
+    })
+    if allowed_pairs is not None:
+        result = result.merge(allowed_pairs, on=['Origin_TAZ', 'Destination_TAZ'])
+
+    result['x0'] = centroid_xy['x'].reindex(result['Origin_TAZ']).to_numpy()
+    result['y0'] = centroid_xy['y'].reindex(result['Origin_TAZ']).to_numpy()
+    result['x1'] = centroid_xy['x'].reindex(result['Destination_TAZ']).to_numpy()
+    result['y1'] = centroid_xy['y'].reindex(result['Destination_TAZ']).to_numpy()
+    result = result.dropna(subset=['x0', 'x1']).reset_index(drop=True)
+    result['Length'] = np.hypot(result['x1'] - result['x0'], result['y1'] - result['y0'])
+    return result
+
+
+class ODQueryHandler(BaseHTTPRequestHandler):
+    """
+    本地查询服务的请求处理
+    GET  /status 返回缓存状态
+    POST /query  请求体为JSON: {"targets": [...]} 或 {"origins": [...], "destinations": [...]}，
+                 可选 "min_flow"、"min_distance"、"max_distance"（米）、"format" ("geojson" 或 "arrow")
+    """
+
+    def _send(self, status, body, content_type='application/json; charset=utf-8'):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, status, payload):
+        self._send(status, json.dumps(payload, ensure_ascii=False).encode('utf-8'))
+
+    def do_GET(self):
+        if self.path == '/status':
+            self._send_json(200, {'zones': len(self.server.origin_positions), 'cache': self.server.cache.stats()})
+        else:
+            self._send_json(404, {'error': f"未知路径: {self.path}"})
+
+    def do_POST(self):
+        if self.path != '/query':
+            self._send_json(404, {'error': f"未知路径: {self.path}"})
+            return
+
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+            targets = request.get('targets', [])
+            origins = [int(z) for z in request.get('origins', targets)]
+            dests = [int(z) for z in request.get('destinations', targets)]
+            min_flow = float(request.get('min_flow', 0))
+            min_dist = None if request.get('min_distance') is None else float(request['min_distance'])
+            max_dist = None if request.get('max_distance') is None else float(request['max_distance'])
+            output_format = request.get('format', 'geojson')
+        except (ValueError, TypeError, AttributeError) as e:
+            self._send_json(400, {'error': f"请求格式错误: {e}"})
+            return
+
+        if output_format not in ('geojson', 'arrow'):
+            self._send_json(400, {'error': f"未知输出格式: {output_format}"})
+            return
+        if output_format == 'arrow':
+            try:
+                import pyarrow as pa
+            except ImportError:
+                self._send_json(501, {'error': "未安装pyarrow，无法输出Arrow格式"})
+                return
+
+        try:
+            result = query_desire_lines(self.server.od_values, self.server.origin_positions, self.server.dest_ids,
+                                        self.server.centroid_xy, self.server.cache, origins, dests, min_flow,
+                                        min_dist, max_dist)
+
+            if output_format == 'arrow':
+                table = pa.Table.from_pandas(result, preserve_index=False)
+                sink = pa.BufferOutputStream()
+                with pa.ipc.new_stream(sink, table.schema) as writer:
+                    writer.write_table(table)
+                body = sink.getvalue().to_pybytes()
+                content_type = 'application/vnd.apache.arrow.stream'
+            else:
+                payload = {'type': 'FeatureCollection', 'features': list(iter_geojson_features(result))}
+                body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+                content_type = 'application/json; charset=utf-8'
+        except (OverflowError, ValueError, TypeError) as e:
+            # 如超出int64范围的小区编号、非法的距离取值等
+            self._send_json(400, {'error': f"请求参数错误: {e}"})
+            return
+        except Exception as e:
+            self._send_json(500, {'error': f"查询失败: {e}"})
+            return
+
+        self._send(200, body, content_type)
+
+    def log_message(self, format, *args):
+        print(f"[服务] {self.address_string()} {format % args}")
+
+
+def run_query_server(df_od, centroid_xy, port, cache_mb):
+    """启动本地查询服务，OD矩阵与中心点常驻内存，直到按Ctrl+C退出"""
+    server = ThreadingHTTPServer(('127.0.0.1', port), ODQueryHandler)
+    server.od_values = df_od.to_numpy(dtype=float)
+    server.origin_positions = {int(z): i for i, z in enumerate(pd.to_numeric(pd.Index(df_od.index), errors='coerce'))
+                               if pd.notna(z)}
+    server.dest_ids = np.asarray(pd.to_numeric(pd.Index(df_od.columns).astype(str).str.strip(),
+                                               errors='coerce').fillna(-1), dtype='int64')
+    server.centroid_xy = centroid_xy
+    server.cache = ODRowCache(cache_mb * 1024 * 1024)
+
+    print(f"✅ 查询服务已启动: http://127.0.0.1:{port}")
+    print(f"   POST /query  例: {{\"targets\": [53621, 53622], \"format\": \"geojson\"}}")
+    print(f"   GET  /status 查看缓存状态")
+    print(f"   按 Ctrl+C 停止服务")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print(f"\n服务已停止")
+    finally:
+        server.server_close()
+
+
+def read_od_block(csv_path, zone_ids, encoding, chunksize=5000):
+    """
+    只读取指定小区之间的OD子矩阵：按表头挑选列，再分块筛选行，不加载整张矩阵
+    返回: 以TAZ编号（整数）为行列索引的DataFrame
+    """
+    zone_ids = {int(z) for z in zone_ids}
+    header = pd.read_csv(csv_path, nrows=0, encoding=encoding).columns
+    use_positions = [0] + [i for i, col in enumerate(header)
+                           if i > 0 and pd.to_numeric(str(col).strip(), errors='coerce') in zone_ids]
+
+    blocks = []
+    reader = pd.read_csv(csv_path, index_col=0, usecols=use_positions, encoding=encoding, chunksize=chunksize)
+    for chunk in reader:
+        chunk_ids = pd.to_numeric(pd.Index(chunk.index), errors='coerce')
+        blocks.append(chunk[chunk_ids.isin(zone_ids)])
+
+    block = pd.concat(blocks)
+    block.index = pd.to_numeric(pd.Index(block.index), errors='coerce').astype('int64')
+    block.columns = pd.to_numeric(pd.Index(block.columns).astype(str).str.strip()).astype('int64')
+    return block
+
+
+def slice_od_block(df_od, zone_ids):
+    """
+    从已读取的OD矩阵中切出指定小区之间的子矩阵
+    返回: 与 read_od_block 格式相同、以TAZ编号（整数）为行列索引的DataFrame
+    """
+    zone_ids = {int(z) for z in zone_ids}
+    row_ids = pd.to_numeric(pd.Index(df_od.index), errors='coerce')
+    col_ids = pd.to_numeric(pd.Index(df_od.columns).astype(str).str.strip(), errors='coerce')
+    row_mask = row_ids.isin(zone_ids)
+    col_mask = col_ids.isin(zone_ids)
+
+    block = df_od.iloc[np.nonzero(row_mask)[0], np.nonzero(col_mask)[0]].copy()
+    block.index = row_ids[row_mask].astype('int64')
+    block.columns = col_ids[col_mask].astype('int64')
+    return block
+
+
+def compute_od_change(block_a, block_b, abs_threshold, rel_threshold):
+    """
+    将两期OD子矩阵对齐到共同的小区索引，一次性计算绝对和相对变化
+    返回: 通过变化阈值的OD对DataFrame
+    """
+    a, b = block_a.align(block_b, join='outer', fill_value=0)
+    flow_a = a.fillna(0).to_numpy(dtype=float)
+    flow_b = b.fillna(0).to_numpy(dtype=float)
+    change = flow_b - flow_a
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rel_change = np.where(flow_a > 0, change / flow_a, np.nan)
+
+    passed = (change != 0) & (np.abs(change) >= abs_threshold) & \
+             ((flow_a == 0) | (np.abs(rel_change) >= rel_threshold))
+    rows, cols = np.nonzero(passed)
+
+    return pd.DataFrame({
+        'Origin_TAZ': a.index.to_numpy()[rows],
+        'Destination_TAZ': a.columns.to_numpy()[cols],
+        'Flow_A': flow_a[rows, cols],
+        'Flow_B': flow_b[rows, cols],
+        'Change': change[rows, cols],
+        'RelChange': rel_change[rows, cols]
+    })
+
+
+SHAPEFILE_EXTENSIONS = ['.shp', '.shx', '.dbf', '.prj', '.cpg']
+
+
+def file_fingerprint(path, block_size=1 << 20):
+    """按文件内容计算SHA-256指纹，文件不存在时返回None"""
+    if not path or not os.path.exists(path):
+        return None
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def compute_run_key(input_files, options):
+    """由全部输入文件的内容指纹和运行选项计算本次运行的缓存键"""
+    digest = hashlib.sha256()
+    for path in input_files:
+        digest.update(f"{path}={file_fingerprint(path)}\n".encode('utf-8'))
+    digest.update(json.dumps(options, sort_keys=True, ensure_ascii=False, default=str).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def _place_file(source, target):
+    """将缓存文件复制到输出路径（不使用硬链接，避免在GIS中编辑输出时改坏缓存）"""
+    target_dir = os.path.dirname(target)
+    if target_dir and not os.path.exists(target_dir):
+        os.makedirs(target_dir)
+    shutil.copy2(source, target)
+
+
+def restore_cached_run(cache_root, run_key):
+    """
+    缓存命中时将缓存的输出放回原输出路径
+    返回: 恢复的输出路径列表，未命中时返回None
+    """
+    entry_dir = os.path.join(cache_root, run_key)
+    manifest_path = os.path.join(entry_dir, 'manifest.json')
+    if not os.path.exists(manifest_path):
+        return None
+
+    with open(manifest_path, 'r', encoding='utf-8') as f:
+        manifest = json.load(f)
+
+    for item in manifest['outputs']:
+        source = os.path.join(entry_dir, item['cached'])
+        if item['is_dir']:
+            for root, _, files in os.walk(source):
+                for name in files:
+                    relative = os.path.relpath(os.path.join(root, name), source)
+                    _place_file(os.path.join(root, name), os.path.join(item['target'], relative))
+        else:
+            _place_file(source, item['target'])
+
+    # 更新使用时间，供淘汰时判断
+    os.utime(manifest_path)
+    return [item['target'] for item in manifest['outputs']]
+
+
+def written_shapefile_parts(shp_path, since):
+    """返回shp及其附属文件中本次运行（since之后）写出的文件"""
+    parts = [os.path.splitext(shp_path)[0] + ext for ext in SHAPEFILE_EXTENSIONS]
+    return [path for path in parts if os.path.exists(path) and os.path.getmtime(path) >= since]
+
+
+def _dir_size(path):
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, files in os.walk(path) for name in files)
+
+
+def store_cached_run(cache_root, run_key, output_paths, max_bytes):
+    """将本次运行的输出保存到缓存目录，并按大小上限淘汰最久未使用的缓存"""
+    entry_dir = os.path.join(cache_root, run_key)
+    tmp_dir = entry_dir + '.tmp'
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+
+    outputs = []
+    for i, path in enumerate(output_paths):
+        cached = f"{i:03d}_{os.path.basename(os.path.normpath(path))}"
+        if os.path.isdir(path):
+            shutil.copytree(path, os.path.join(tmp_dir, cached))
+        else:
+            shutil.copy2(path, os.path.join(tmp_dir, cached))
+        outputs.append({'target': path, 'cached': cached, 'is_dir': os.path.isdir(path)})
+
+    with open(os.path.join(tmp_dir, 'manifest.json'), 'w', encoding='utf-8') as f:
+        json.dump({'key': run_key, 'outputs': outputs}, f, ensure_ascii=False, indent=2)
+    if os.path.exists(entry_dir):
+        shutil.rmtree(entry_dir)
+    os.rename(tmp_dir, entry_dir)
+
+    # 按最近使用时间淘汰，当前结果始终保留
+    entries = []
+    for name in os.listdir(cache_root):
+        manifest_path = os.path.join(cache_root, name, 'manifest.json')
+        if os.path.exists(manifest_path):
+            entries.append((os.path.getmtime(manifest_path), name, _dir_size(os.path.join(cache_root, name))))
+    total = sum(size for _, _, size in entries)
+    for _, name, size in sorted(entries):
+        if total <= max_bytes:
+            break
+        if name == run_key:
+            continue
+        shutil.rmtree(os.path.join(cache_root, name), ignore_errors=True)
+        total -= size
+        print(f"   淘汰缓存: {name[:12]}")
+
+
+# =====================
+# 结果缓存检查：输入与选项未变化时直接复用上次的输出
+# =====================
+run_key = None
+run_start = time.time()
+run_outputs = []  # 本次运行实际写出的输出，只有这些会进入缓存
+output_save_failed = False
+if cache_dir and not serve_port and ndjson_output != '-':
+    print(f"\n=== 结果缓存检查 ===")
+    # 工具自身的代码也计入缓存键，升级脚本后不会复用旧版本的结果
+    tool_dir = os.path.dirname(os.path.abspath(__file__))
+    cache_inputs = [os.path.abspath(__file__), os.path.join(tool_dir, 'dbf_reader.py')] + \
+                   [csv_file, compare_csv_file] + \
+                   [os.path.splitext(shp_file)[0] + ext for ext in SHAPEFILE_EXTENSIONS]
+    cache_options = {
+        'target_tazs': sorted(target_tazs),
+        'output_shp': output_shp,
+        'min_distance': min_distance,
+        'max_distance': max_distance,
+        'stats_output': stats_output,
+        'stats_scope': stats_scope,
+        'distance_bands': distance_bands,
+        'histogram_bin_width': histogram_bin_width,
+        'shard_mode': shard_mode,
+        'shard_output_dir': shard_output_dir,
+        'shard_max_features': shard_max_features,
+        'shard_tile_size': shard_tile_size,
+        'compare_output_shp': compare_output_shp,
+        'change_abs_threshold': change_abs_threshold,
+        'change_rel_threshold': change_rel_threshold,
+        'density_output': density_output,
+        'density_cell_size': density_cell_size,
+        'density_extent': density_extent,
+        'ndjson_output': ndjson_output,
+        'stream_chunk_size': stream_chunk_size
+    }
+    run_key = compute_run_key(cache_inputs, cache_options)
+    print(f"缓存键: {run_key[:12]}")
+
+    restored = restore_cached_run(cache_dir, run_key)
+    if restored is not None:
+        print(f"✅ 输入和选项均未变化，已从缓存恢复 {len(restored)} 项输出:")
+        for path in restored:
+            print(f"   {path}")
+        sys.exit(0)
+    print(f"未命中缓存，开始完整处理")
+
 # =====================
 # 步骤1: 读取OD流量数据 (交通小区矩阵)
 # =====================
@@ -172,17 +1060,18 @@ try:
 
         if os.path.exists(dbf_path):
             try:
-                from simpledbf import Dbf5
+                from dbf_reader import read_dbf, detect_dbf_encoding
 
-                # 尝试不同编码读取dbf
-                dbf_encodings = ['gbk', 'utf-8', 'gb2312']
+                # 优先使用.cpg或文件头中记录的编码，再尝试常用编码
+                header_encoding = detect_dbf_encoding(dbf_path)
+                print(f"DBF文件声明的编码: {header_encoding}")
+                dbf_encodings = list(dict.fromkeys([header_encoding, 'gbk', 'utf-8', 'gb2312']))
                 df_dbf = None
 
                 for encoding in dbf_encodings:
                     try:
                         print(f"尝试编码 {encoding} 读取dbf...", end="")
-                        dbf = Dbf5(dbf_path, codec=encoding)
-                        df_dbf = dbf.to_dataframe()
+                        df_dbf = read_dbf(dbf_path, encoding)
                         print(f"✅")
                         break
                     except:
@@ -192,9 +1081,13 @@ try:
                     print(f"✅ 成功读取dbf文件")
                     print(f"   字段数: {len(df_dbf.columns)}")
 
-                    # 读取geometry
+                    # 读取geometry，跳过属性字段以免再次解码属性表
                     print(f"读取geometry数据...")
-                    gdf_geo = gpd.read_file(shp_file)
+                    try:
+                        gdf_geo = gpd.read_file(shp_file, ignore_fields=list(df_dbf.columns))
+                    except Exception:
+                        gdf_geo = gpd.read_file(shp_file)
+                    gdf_geo = gdf_geo[['geometry']]
 
                     # 合并数据
                     if len(df_dbf) == len(gdf_geo):
@@ -280,6 +1173,8 @@ print(f"\n当前选择的TAZ字段: '{taz_field}'")
 try:
     user_input = input("\n是否使用此字段作为TAZ标识？(y/n): ").strip().lower()
     if user_input == 'n':
+        # 手动选择的字段不在缓存键中，本次结果不写入缓存
+        run_key = None
         field_num = int(input(f"请输入TAZ字段的编号 (1-{len(gdf_zones.columns)}): ")) - 1
         if 0 <= field_num < len(gdf_zones.columns):
             taz_field = gdf_zones.columns[field_num]
@@ -329,9 +1224,26 @@ if taz_field:
         zone_centroids = gdf_zones.set_index(taz_field).geometry.centroid.to_dict()
         print(f"使用索引作为TAZ，共 {len(zone_ids)} 个区域")
 
+    # 中心点坐标数组，供向量化计算使用
+    centroid_xy = pd.DataFrame({
+        'x': [point.x for point in zone_centroids.values()],
+        'y': [point.y for point in zone_centroids.values()]
+    }, index=pd.Index(list(zone_centroids.keys())))
+    centroid_xy = centroid_xy[centroid_xy.index.notna()]
+    centroid_xy.index = centroid_xy.index.astype('int64')
+    centroid_xy = centroid_xy[~centroid_xy.index.duplicated()]
+
 else:
     raise ValueError("无法找到合适的TAZ字段，请检查shapefile数据")
 
+# =====================
+# 本地查询服务模式（OD矩阵和中心点常驻内存）
+# =====================
+if serve_port:
+    print(f"\n=== 本地查询服务 ===")
+    run_query_server(df_od, centroid_xy, serve_port, serve_cache_mb)
+    sys.exit(0)
+
 # =====================
 # 步骤4: 筛选OD数据
 # =====================
@@ -351,69 +1263,183 @@ if valid_origins and valid_destinations:
 else:
     print("警告: 没有找到有效的TAZ，请检查目标TAZ编号是否正确")
 
-# 筛选OD数据，只保留在目标TAZ之间的出行
-filtered_od_data = []
-for origin in valid_origins:
-    for dest in valid_destinations:
-        if dest in df_od.columns and origin in df_od.index:
-            flow = df_od.loc[origin, dest]
-            if flow > 0:  # 只保留有流量的OD对
-                filtered_od_data.append({
-                    'Origin_TAZ': origin,
-                    'Destination_TAZ': dest,
-                    'Flow': flow
-                })
-
-# 转换为DataFrame
-filtered_df = pd.DataFrame(filtered_od_data)
-print(f"筛选后的OD数据数量: {len(filtered_df)}")
-
-if len(filtered_df) > 0:
-    print(f"OD流量统计:")
-    print(f"  最小流量: {filtered_df['Flow'].min()}")
-    print(f"  最大流量: {filtered_df['Flow'].max()}")
-    print(f"  平均流量: {filtered_df['Flow'].mean():.2f}")
-    print(f"  总流量: {filtered_df['Flow'].sum()}")
+stream_count = None
+if ndjson_output:
+    # 流式输出：按块筛选并直接写出，不在内存中保留完整的OD列表和线要素
+    print(f"\n=== 流式输出期望线 (NDJSON) ===")
+    print(f"输出目标: {'标准输出' if ndjson_output == '-' else ndjson_output}，分块大小: {stream_chunk_size}")
+    chunks = iter_desire_line_chunks(df_od, valid_origins, valid_destinations, centroid_xy, stream_chunk_size,
+                                     min_distance, max_distance)
+    if ndjson_stream is not None:
+        stream_count = write_ndjson_lines(chunks, ndjson_stream)
+    else:
+        ndjson_dir = os.path.dirname(ndjson_output)
+        if ndjson_dir and not os.path.exists(ndjson_dir):
+            os.makedirs(ndjson_dir)
+        with open(ndjson_output, 'w', encoding='utf-8') as f:
+            stream_count = write_ndjson_lines(chunks, f)
+        run_outputs.append(ndjson_output)
+    print(f"✅ 流式写出 {stream_count} 条期望线")
+    filtered_df = pd.DataFrame(columns=['Origin_TAZ', 'Destination_TAZ', 'Flow'])
+elif min_distance is not None or max_distance is not None:
+    # 距离筛选：先按中心点距离选出OD对，只为保留下来的OD对提取流量
+    print(f"距离范围: {min_distance if min_distance is not None else 0} ~ "
+          f"{max_distance if max_distance is not None else '不限'} 米")
+    pair_rows, pair_cols = select_pairs_by_distance(valid_origins, valid_destinations, centroid_xy,
+                                                    min_distance, max_distance)
+    print(f"距离范围内的OD对数量: {len(pair_rows)} / {len(valid_origins) * len(valid_destinations)}")
+
+    row_index = df_od.index.get_indexer(valid_origins)[pair_rows]
+    col_index = df_od.columns.get_indexer(valid_destinations)[pair_cols]
+    pair_flows = df_od.values[row_index, col_index]
+    has_flow = pair_flows > 0  # 只保留有流量的OD对
+    filtered_df = pd.DataFrame({
+        'Origin_TAZ': np.asarray(valid_origins)[pair_rows[has_flow]],
+        'Destination_TAZ': np.asarray(valid_destinations)[pair_cols[has_flow]],
+        'Flow': pair_flows[has_flow]
+    })
 else:
-    print("没有找到符合条件的OD数据")
+    # 筛选OD数据，只保留在目标TAZ之间的出行
+    filtered_od_data = []
+    for origin in valid_origins:
+        for dest in valid_destinations:
+            if dest in df_od.columns and origin in df_od.index:
+                flow = df_od.loc[origin, dest]
+                if flow > 0:  # 只保留有流量的OD对
+                    filtered_od_data.append({
+                        'Origin_TAZ': origin,
+                        'Destination_TAZ': dest,
+                        'Flow': flow
+                    })
+
+    # 转换为DataFrame
+    filtered_df = pd.DataFrame(filtered_od_data)
+
+if not ndjson_output:
+    print(f"筛选后的OD数据数量: {len(filtered_df)}")
+
+    if len(filtered_df) > 0:
+        print(f"OD流量统计:")
+        print(f"  最小流量: {filtered_df['Flow'].min()}")
+        print(f"  最大流量: {filtered_df['Flow'].max()}")
+        print(f"  平均流量: {filtered_df['Flow'].mean():.2f}")
+        print(f"  总流量: {filtered_df['Flow'].sum()}")
+    else:
+        print("没有找到符合条件的OD数据")
 
 # =====================
 # 步骤5: 构建线要素（LineString）—— 需要空间坐标
 # =====================
-print(f"\n=== 步骤5: 构建期望线 ===")
 lines = []
 invalid_count = 0
 
-for _, row in filtered_df.iterrows():
-    origin_id = row['Origin_TAZ']
-    dest_id = row['Destination_TAZ']
-    flow = row['Flow']
-
-    if origin_id not in zone_centroids or dest_id not in zone_centroids:
-        invalid_count += 1
-        continue
-
-    origin_point = zone_centroids[origin_id]
-    dest_point = zone_centroids[dest_id]
-
-    # 检查点是否有效
-    if origin_point.is_valid and dest_point.is_valid:
-        line_geom = LineString([origin_point, dest_point])
-        lines.append({
-            'geometry': line_geom,
-            'properties': {
-                'Origin_TAZ': origin_id,
-                'Destination_TAZ': dest_id,
-                'Flow': flow,
-                'Length': line_geom.length  # 添加线长度
-            }
-        })
+if not ndjson_output:
+    print(f"\n=== 步骤5: 构建期望线 ===")
+
+    for _, row in filtered_df.iterrows():
+        origin_id = row['Origin_TAZ']
+        dest_id = row['Destination_TAZ']
+        flow = row['Flow']
+
+        if origin_id not in zone_centroids or dest_id not in zone_centroids:
+            invalid_count += 1
+            continue
+
+        origin_point = zone_centroids[origin_id]
+        dest_point = zone_centroids[dest_id]
+
+        # 检查点是否有效
+        if origin_point.is_valid and dest_point.is_valid:
+            line_geom = LineString([origin_point, dest_point])
+            lines.append({
+                'geometry': line_geom,
+                'properties': {
+                    'Origin_TAZ': origin_id,
+                    'Destination_TAZ': dest_id,
+                    'Flow': flow,
+                    'Length': line_geom.length  # 添加线长度
+                }
+            })
+        else:
+            invalid_count += 1
+
+    print(f"成功创建 {len(lines)} 条期望线")
+    if invalid_count > 0:
+        print(f"无法创建 {invalid_count} 条线（无效的TAZ或几何）")
+
+# =====================
+# 步骤5b: 出行距离分布统计（向量化，不构建几何）
+# =====================
+stats_df = None
+if stats_output:
+    print(f"\n=== 步骤5b: 出行距离分布统计 ===")
+    if stats_scope == 'all':
+        od_block = df_od
+        print(f"统计范围: 全市OD矩阵 ({df_od.shape[0]} x {df_od.shape[1]})")
     else:
-        invalid_count += 1
+        od_block = df_od.loc[valid_origins, valid_destinations]
+        print(f"统计范围: 目标小区之间 ({len(valid_origins)} x {len(valid_destinations)})")
+
+    if min_distance is not None or max_distance is not None:
+        print(f"距离范围: {min_distance if min_distance is not None else 0} ~ "
+              f"{max_distance if max_distance is not None else '不限'} 米（与期望线一致）")
+
+    stats_df, missing_flow = compute_trip_length_stats(od_block, centroid_xy, distance_bands, histogram_bin_width,
+                                                       min_distance, max_distance)
+    total_row = stats_df[stats_df['Category'] == 'total'].iloc[0]
+    intrazonal_row = stats_df[stats_df['Category'] == 'intrazonal'].iloc[0]
+
+    print(f"  OD对数量: {total_row['Pairs']}")
+    print(f"  总流量: {total_row['Flow']}")
+    print(f"  流量加权平均距离: {total_row['MeanDist']:.1f} 米")
+    print(f"  区内出行占比: {intrazonal_row['Share']:.2%}")
+    if missing_flow > 0:
+        print(f"  警告: {missing_flow} 的流量因缺少中心点坐标未计入统计")
+    print(f"距离分段统计:")
+    for _, row in stats_df[stats_df['Category'] == 'band'].iterrows():
+        print(f"  {row['Item']:>12} 米: 流量 {row['Flow']:.0f} ({row['Share']:.2%}), OD对 {row['Pairs']}")
+
+    stats_dir = os.path.dirname(stats_output)
+    if stats_dir and not os.path.exists(stats_dir):
+        os.makedirs(stats_dir)
+    stats_df.to_csv(stats_output, index=False, encoding='utf-8-sig')
+    run_outputs.append(stats_output)
+    print(f"✅ 距离统计表已保存至: {stats_output}")
 
-print(f"成功创建 {len(lines)} 条期望线")
-if invalid_count > 0:
-    print(f"无法创建 {invalid_count} 条线（无效的TAZ或几何）")
+# =====================
+# 步骤5c: 期望线密度栅格
+# =====================
+if density_output:
+    print(f"\n=== 步骤5c: 生成期望线密度栅格 ===")
+    extent = density_extent if density_extent else tuple(gdf_zones.total_bounds)
+
+    # 直接从OD子矩阵按块取出OD对坐标数组累加，不依赖步骤4-5的线要素，流式模式下同样可用
+    density_grid, density_origin = None, None
+    density_lines = 0
+    for chunk in iter_desire_line_chunks(df_od, valid_origins, valid_destinations, centroid_xy, stream_chunk_size,
+                                         min_distance, max_distance):
+        density_grid, density_origin = rasterize_desire_lines(
+            chunk['x0'].to_numpy(), chunk['y0'].to_numpy(), chunk['x1'].to_numpy(), chunk['y1'].to_numpy(),
+            chunk['Flow'].to_numpy(dtype=float), extent, density_cell_size, density_grid
+        )
+        density_lines += len(chunk)
+
+if density_output and density_grid is None:
+    print(f"⚠️  没有可栅格化的期望线，未生成密度栅格")
+elif density_output:
+    print(f"  栅格化期望线: {density_lines} 条")
+    print(f"  栅格大小: {density_grid.shape[0]} 行 x {density_grid.shape[1]} 列，格网 {density_cell_size} 米")
+    print(f"  非零格网数: {np.count_nonzero(density_grid)}")
+    print(f"  最大格网值 (流量×米): {density_grid.max():.1f}")
+
+    density_dir = os.path.dirname(density_output)
+    if density_dir and not os.path.exists(density_dir):
+        os.makedirs(density_dir)
+    saved_density = save_density_raster(density_grid, density_origin, density_cell_size, gdf_zones.crs, density_output)
+    run_outputs.append(saved_density)
+    if saved_density.lower().endswith('.npy'):
+        run_outputs.append(os.path.splitext(saved_density)[0] + '.json')
+    print(f"✅ 密度栅格已保存至: {saved_density}")
 
 # =====================
 # 步骤6: 创建GeoDataFrame并保存为shp
@@ -434,35 +1460,117 @@ if lines:
 
     # 确保输出目录存在
     output_dir = os.path.dirname(output_shp)
-    if not os.path.exists(output_dir):
+    if not shard_mode and not os.path.exists(output_dir):
         os.makedirs(output_dir)
         print(f"创建输出目录: {output_dir}")
 
-    # 保存为shp文件 - 尝试最佳编码
-    try:
-        save_encodings = ['gbk', 'utf-8'] if best_encoding is None else [best_encoding, 'gbk', 'utf-8']
+    save_encodings = ['gbk', 'utf-8'] if best_encoding is None else [best_encoding, 'gbk', 'utf-8']
+
+    if shard_mode:
+        # 分片并行保存，并生成索引文件
+        manifest_path = write_sharded_lines(gdf_lines, centroid_xy, shard_output_dir, shard_mode,
+                                            shard_max_features, shard_tile_size, shard_workers, save_encodings)
+        print(f"✅ 分片保存完成，索引文件: {manifest_path}")
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            for shard in json.load(f)['shards']:
+                run_outputs += written_shapefile_parts(os.path.join(shard_output_dir, shard['file']), run_start)
+        run_outputs.append(manifest_path)
+    else:
+        # 保存为shp文件 - 尝试最佳编码
+        try:
+            for encoding in save_encodings:
+                try:
+                    print(f"尝试使用编码 '{encoding}' 保存...")
+                    gdf_lines.to_file(output_shp, driver='ESRI Shapefile', encoding=encoding)
+                    print(f"✅ 成功保存至: {output_shp}")
+
+                    # 验证保存的文件
+                    saved_gdf = gpd.read_file(output_shp, encoding=encoding)
+                    print(f"✅ 保存验证成功")
+                    print(f"   保存的记录数: {len(saved_gdf)}")
+                    run_outputs += written_shapefile_parts(output_shp, run_start)
+                    break
+
+                except Exception as e:
+                    print(f"❌ 编码 '{encoding}' 保存失败: {str(e)[:100]}")
+            else:
+                output_save_failed = True
+
+        except Exception as e:
+            print(f"❌ 所有保存尝试都失败: {e}")
+            raise
+
+elif not ndjson_output:
+    print("未找到有效的OD线段，无法生成shp文件。")
+
+# =====================
+# 步骤7: OD变化检测（两期矩阵对比）
+# =====================
+change_df = None
+if compare_csv_file:
+    print(f"\n=== 步骤7: OD变化检测 ===")
+    print(f"基准期: {csv_file}")
+    print(f"对比期: {compare_csv_file}")
+
+    # 基准期子矩阵从已读取的df_od中切出，不再重复解析CSV；对比期只读取目标子矩阵
+    df_od_base = slice_od_block(df_od, target_tazs)
+
+    df_od_compare = None
+    for encoding in csv_encodings:
+        try:
+            print(f"尝试编码 {encoding} 读取对比期CSV子矩阵...", end="")
+            df_od_compare = read_od_block(compare_csv_file, target_tazs, encoding)
+            print(f"✅")
+            break
+        except:
+            print(f"❌", end="")
+
+    if df_od_compare is None:
+        raise ValueError(f"无法读取对比期CSV文件: {compare_csv_file}")
+
+    change_df = compute_od_change(df_od_base, df_od_compare, change_abs_threshold, change_rel_threshold)
+    print(f"通过变化阈值的OD对数量: {len(change_df)}")
+
+    # 只保留两端都有中心点的OD对
+    has_centroid = change_df['Origin_TAZ'].isin(centroid_xy.index) & change_df['Destination_TAZ'].isin(centroid_xy.index)
+    if (~has_centroid).sum() > 0:
+        print(f"警告: {(~has_centroid).sum()} 个OD对缺少中心点，已跳过")
+    change_df = change_df[has_centroid].reset_index(drop=True)
+
+    if len(change_df) > 0:
+        print(f"  增加的OD对: {(change_df['Change'] > 0).sum()}，减少的OD对: {(change_df['Change'] < 0).sum()}")
+        print(f"  净变化: {change_df['Change'].sum()}")
 
+        ox = centroid_xy['x'].reindex(change_df['Origin_TAZ']).to_numpy()
+        oy = centroid_xy['y'].reindex(change_df['Origin_TAZ']).to_numpy()
+        dx = centroid_xy['x'].reindex(change_df['Destination_TAZ']).to_numpy()
+        dy = centroid_xy['y'].reindex(change_df['Destination_TAZ']).to_numpy()
+        change_df['Length'] = np.hypot(dx - ox, dy - oy)
+
+        gdf_change = gpd.GeoDataFrame(
+            change_df,
+            geometry=[LineString([(x0, y0), (x1, y1)]) for x0, y0, x1, y1 in zip(ox, oy, dx, dy)],
+            crs=gdf_zones.crs
+        )
+
+        compare_dir = os.path.dirname(compare_output_shp)
+        if compare_dir and not os.path.exists(compare_dir):
+            os.makedirs(compare_dir)
+
+        save_encodings = ['gbk', 'utf-8'] if best_encoding is None else [best_encoding, 'gbk', 'utf-8']
         for encoding in save_encodings:
             try:
-                print(f"尝试使用编码 '{encoding}' 保存...")
-                gdf_lines.to_file(output_shp, driver='ESRI Shapefile', encoding=encoding)
-                print(f"✅ 成功保存至: {output_shp}")
-
-                # 验证保存的文件
-                saved_gdf = gpd.read_file(output_shp, encoding=encoding)
-                print(f"✅ 保存验证成功")
-                print(f"   保存的记录数: {len(saved_gdf)}")
+                print(f"尝试使用编码 '{encoding}' 保存变化期望线...")
+                gdf_change.to_file(compare_output_shp, driver='ESRI Shapefile', encoding=encoding)
+                print(f"✅ 成功保存至: {compare_output_shp}")
+                run_outputs += written_shapefile_parts(compare_output_shp, run_start)
                 break
-
             except Exception as e:
                 print(f"❌ 编码 '{encoding}' 保存失败: {str(e)[:100]}")
-
-    except Exception as e:
-        print(f"❌ 所有保存尝试都失败: {e}")
-        raise
-
-else:
-    print("未找到有效的OD线段，无法生成shp文件。")
+        else:
+            output_save_failed = True
+    else:
+        print("没有OD对通过变化阈值，未生成变化期望线")
 
 print(f"\n" + "=" * 60)
 print("处理完成！")
@@ -471,8 +1579,23 @@ print(f"总步骤总结:")
 print(f"1. 读取OD数据: {df_od.shape[0]} x {df_od.shape[1]} 矩阵")
 print(f"2. 读取交通小区: {len(gdf_zones)} 个区域")
 print(f"3. 筛选目标TAZ: {len(valid_origins)} 个有效起点, {len(valid_destinations)} 个有效终点")
-print(f"4. 筛选OD数据: {len(filtered_df)} 条记录")
-print(f"5. 生成期望线: {len(lines)} 条")
+if stream_count is not None:
+    print(f"4-5. 流式输出期望线: {stream_count} 条 -> {'标准输出' if ndjson_output == '-' else ndjson_output}")
+else:
+    print(f"4. 筛选OD数据: {len(filtered_df)} 条记录")
+    print(f"5. 生成期望线: {len(lines)} 条")
 if lines:
-    print(f"6. 输出文件: {output_shp}")
+    print(f"6. 输出文件: {shard_output_dir if shard_mode else output_shp}")
+if stats_df is not None:
+    print(f"   距离统计表: {stats_output}")
+if change_df is not None:
+    print(f"7. 变化检测: {len(change_df)} 条变化期望线 -> {compare_output_shp}")
 
+# =====================
+# 保存结果到缓存
+# =====================
+if run_key and output_save_failed:
+    print(f"⚠️  本次有输出保存失败，结果不写入缓存")
+elif run_key and run_outputs:
+    store_cached_run(cache_dir, run_key, run_outputs, cache_max_mb * 1024 * 1024)
+    print(f"已缓存本次输出 ({len(run_outputs)} 项)，缓存键: {run_key[:12]}")